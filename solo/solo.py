@@ -6,20 +6,24 @@ import anndata
 
 import numpy as np
 import scipy.sparse as sp
-from sklearn.metrics import roc_auc_score, roc_curve
-from collections import defaultdict
 
 import scvi
-from scvi.dataset import AnnDatasetFromAnnData, LoomDataset, \
-    GeneExpressionDataset, Dataset10X
+from scvi.dataset import AnnDatasetFromAnnData, LoomDataset, Dataset10X
 from scvi.models import Classifier, VAE
 from scvi.inference import UnsupervisedTrainer, ClassifierTrainer
 import torch
-import umap
 
-from .utils import create_average_doublet, create_summed_doublet, \
-    create_multinomial_doublet, make_gene_expression_dataset, \
-    knn_smooth_pred_class
+from .utils import create_average_doublets, create_summed_doublets, \
+    create_multinomial_doublets, make_gene_expression_dataset, \
+    knn_smooth_pred_class, roc_summary, compile_model, load_scdl, \
+    AutocastUnsupervisedTrainer, CountsDataset, LatentDataset, \
+    compute_latent_zl, set_num_threads, DOUBLET_CHUNK_BYTES, \
+    NUMBA_THREADING_LAYER
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 '''
 solo.py
@@ -39,7 +43,7 @@ def main():
     parser.add_argument(dest='model_json_file',
                         help='json file to pass VAE parameters')
     parser.add_argument(dest='data_path',
-                        help='path to h5ad, loom or 10x directory containing cell by genes counts')
+                        help='path to h5ad, loom, scdl or 10x directory containing cell by genes counts')
     parser.add_argument('--set-reproducible-seed', dest='reproducible_seed',
                         default=None, type=int,
                         help='Reproducible seed, give an int to set seed')
@@ -80,8 +84,8 @@ def main():
     parser.add_argument('-e', dest='expected_number_of_doublets',
                         help='Experimentally expected number of doublets',
                         type=int, default=None)
-    parser.add_argument('-p', dest='plot',
-                        default=True, action='store_true',
+    parser.add_argument('-p', '--plot', dest='plot',
+                        default=False, action='store_true',
                         help='Plot outputs for solo')
     parser.add_argument('-l', dest='normal_logging',
                         default=False, action='store_true',
@@ -101,28 +105,64 @@ def main():
                         default=False,
                         action='store_true',
                         help='Train VAE on both singlets & doublets (real & fake).')
+    parser.add_argument('--num-workers', dest='num_workers',
+                        default=0, type=int,
+                        help='Number of worker processes gathering \
+                        minibatches, defaults to 0 which loads them in the \
+                        main process')
+    parser.add_argument('--num-threads', dest='num_threads',
+                        default=None, type=int,
+                        help='Maximum number of threads for BLAS/OpenMP, \
+                        torch and numba, defaults to all cores')
+    parser.add_argument('--bf16', dest='bf16',
+                        default=False,
+                        action='store_true',
+                        help='Train the VAE with bfloat16 mixed precision \
+                        and TF32 matmuls, needs a GPU with bfloat16 support')
+    parser.add_argument('--compile', dest='compile',
+                        default=False,
+                        action='store_true',
+                        help='Compile the VAE and classifier with torch.compile \
+                        (torch >= 2.0). The first epochs are slower while \
+                        compiling.')
     args = parser.parse_args()
 
     if not args.normal_logging:
         scvi._settings.set_verbosity(10)
 
+    # pick the layer before the doublet simulation starts numba's thread
+    # pool, unless the user chose one
+    if numba is not None and 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba.config.THREADING_LAYER = NUMBA_THREADING_LAYER
+
+    if args.num_threads is not None:
+        set_num_threads(args.num_threads)
+
     model_json_file = args.model_json_file
     data_path = args.data_path
     if args.gpu and not torch.cuda.is_available():
         args.gpu = torch.cuda.is_available()
         print('Cuda is not available, switching to cpu running!')
 
+    if args.bf16 and not (args.gpu and torch.cuda.is_bf16_supported()):
+        args.bf16 = False
+        print('bfloat16 is not supported, training in float32!')
+    if args.bf16:
+        # TF32 for the matmuls left in float32
+        torch.set_float32_matmul_precision('high')
+
     if not os.path.isdir(args.out_dir):
         os.mkdir(args.out_dir)
 
     if args.reproducible_seed is not None:
         torch.manual_seed(args.reproducible_seed)
         np.random.seed(args.reproducible_seed)
+    rng = np.random.default_rng(args.reproducible_seed)
     ##################################################
     # data
 
     # read loom/anndata
-    data_ext = os.path.splitext(data_path)[-1]
+    data_ext = os.path.splitext(os.path.normpath(data_path))[-1]
     if data_ext == '.loom':
         scvi_data = LoomDataset(data_path)
     elif data_ext == '.h5ad':
@@ -130,6 +170,9 @@ def main():
         #if sp.issparse(adata.X):
         #    adata.X = adata.X.todense()
         scvi_data = AnnDatasetFromAnnData(adata)
+    elif data_ext == '.scdl':
+        # memory-mapped CSR written by solo.utils.convert_to_scdl
+        scvi_data = load_scdl(data_path)
     elif os.path.isdir(data_path):
         scvi_data = Dataset10X(save_path=data_path,
                                measurement_names_column=1,
@@ -144,7 +187,7 @@ def main():
         print(f"Min cell depth: {min_cell_umi_depth}, Max cell depth: {max_cell_umi_depth}")
     else:
         msg = f'{data_path} is not a recognized format.\n'
-        msg += 'must be one of {h5ad, loom, 10x directory}'
+        msg += 'must be one of {h5ad, loom, scdl, 10x directory}'
         raise TypeError(msg)
 
     num_cells, num_genes = scvi_data.X.shape
@@ -200,6 +243,12 @@ def main():
         batch_size = int(np.round(1.25*batch_size))
         print('Increasing batch_size to %d to avoid single example batch.' % batch_size)
 
+    # optionally gather minibatches in worker processes that live across
+    # epochs; every posterior keeps its own workers, so this is opt-in
+    data_loader_kwargs = {'num_workers': args.num_workers}
+    if args.num_workers > 0:
+        data_loader_kwargs['persistent_workers'] = True
+
 
     ##################################################
     # simulate doublets
@@ -207,56 +256,65 @@ def main():
     if args.inter_doublets:
         assert args.inter_doublets in adata.obs
 
-    if sp.issparse(singlet_scvi_data.X):
-        non_zero_indexes = singlet_scvi_data.X.nonzero()
-    else:
-        non_zero_indexes = np.where(singlet_scvi_data.X > 0)
-    cells = non_zero_indexes[0]
-    genes = non_zero_indexes[1]
-    cells_ids = defaultdict(list)
-    for cell_id, gene in zip(cells, genes):
-        cells_ids[cell_id].append(gene)
-
     # choose doublets function type
-    if args.doublet_type == 'average':
-        doublet_function = create_average_doublet
-    elif args.doublet_type == 'sum':
-        doublet_function = create_summed_doublet
-    else:
-        doublet_function = create_multinomial_doublet
+    doublet_functions = {'average': create_average_doublets,
+                         'sum': create_summed_doublets,
+                         'multinomial': create_multinomial_doublets}
 
-    cell_depths = singlet_scvi_data.X.sum(axis=1)
+    # doublets are built from row gathers, so convert to CSR once and keep
+    # the depths as a flat array rather than an (N, 1) np.matrix
+    if sp.issparse(singlet_scvi_data.X):
+        singlet_X = singlet_scvi_data.X.tocsr()
+    else:
+        singlet_X = singlet_scvi_data.X
+    cell_depths = np.asarray(singlet_X.sum(axis=1)).ravel()
     num_doublets = int(args.doublet_ratio * singlet_num_cells)
     if known_doublet_data is not None:
         num_doublets -= known_doublet_data.X.shape[0]
         # make sure we are making a non negative amount of doublets
         assert num_doublets >= 0
 
-    in_silico_doublets = []
+    # sample two cells for all desired # doublets at once
+    pairs = rng.integers(0, singlet_num_cells, size=(num_doublets, 2),
+                         dtype=np.int64)
 
-    # for desired # doublets
-    for di in range(num_doublets):
-        # sample two cells
-        i, j = np.random.choice(singlet_num_cells, size=2)
-
-        if args.inter_doublets:
-            while adata.obs[args.inter_doublets][i] == adata.obs[args.inter_doublets][j]:
-                i, j = np.random.choice(singlet_num_cells, size=2)
-
-        if args.doublet_type == 'mixed':
-            doublet_function = np.random.choice([create_average_doublet,
-                                                 create_summed_doublet,
-                                                 create_multinomial_doublet])
-        # generate doublets
-        in_silico_doublets.append(
-            doublet_function(singlet_scvi_data.X, i, j,
-                             doublet_depth=args.doublet_depth,
-                             cell_depths=cell_depths, cells_ids=cells_ids,
-                             randomize_doublet_size=args.randomize_doublet_size))
+    if args.inter_doublets:
+        groups = np.asarray(adata.obs[args.inter_doublets])
+        same_group = groups[pairs[:, 0]] == groups[pairs[:, 1]]
+        while same_group.any():
+            pairs[same_group] = rng.integers(0, singlet_num_cells,
+                                             size=(same_group.sum(), 2),
+                                             dtype=np.int64)
+            same_group = groups[pairs[:, 0]] == groups[pairs[:, 1]]
+    I, J = pairs[:, 0], pairs[:, 1]
+
+    if args.doublet_type == 'mixed':
+        doublet_types = rng.choice(list(doublet_functions), size=num_doublets)
+    else:
+        doublet_types = np.full(num_doublets, args.doublet_type)
 
+    # generate doublets in chunks so the row gathers (and the float64
+    # copies the multinomial sampler makes of them) stay in a memory budget
+    chunk_size = max(1, DOUBLET_CHUNK_BYTES // (8 * num_genes))
+    in_silico_doublets = []
+    for start in range(0, num_doublets, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        for doublet_type, doublet_function in doublet_functions.items():
+            type_idx = doublet_types[chunk] == doublet_type
+            if type_idx.any():
+                in_silico_doublets.append(
+                    doublet_function(singlet_X,
+                                     I[chunk][type_idx], J[chunk][type_idx],
+                                     doublet_depth=args.doublet_depth,
+                                     cell_depths=cell_depths,
+                                     randomize_doublet_size=args.randomize_doublet_size,
+                                     rng=rng))
+
+    # keep sparse data sparse through the concatenation, as CSR since the
+    # data loaders gather rows
     if sp.issparse(scvi_data.X):
-        in_silico_doublets = sp.vstack(in_silico_doublets)
-        train_data = sp.vstack([scvi_data.X, in_silico_doublets])
+        in_silico_doublets = sp.vstack(in_silico_doublets, format='csr')
+        train_data = sp.vstack([scvi_data.X, in_silico_doublets], format='csr')
     else:
         in_silico_doublets = np.vstack(in_silico_doublets)
         train_data = np.vstack([scvi_data.X, in_silico_doublets])
@@ -264,7 +322,7 @@ def main():
     # merge datasets
     # we can maybe up sample the known doublets
     # concatentate
-    classifier_data = GeneExpressionDataset()
+    classifier_data = CountsDataset()
     classifier_data.populate_from_data(
         X=train_data,
         labels=np.hstack([np.ravel(scvi_data.labels),
@@ -293,7 +351,6 @@ def main():
             vae.load_state_dict(torch.load(os.path.join(args.seed, 'vae.pt'),
                                 map_location=map_loc))
 
-        # save latent representation
         utrainer = \
             UnsupervisedTrainer(vae, vae_data,
                                 train_size=(1. - valid_pct),
@@ -301,29 +358,28 @@ def main():
                                 metrics_to_monitor=['reconstruction_error'],
                                 use_cuda=args.gpu,
                                 early_stopping_kwargs=stopping_params,
+                                data_loader_kwargs=data_loader_kwargs,
                                 batch_size=batch_size)
 
-        full_posterior = utrainer.create_posterior(
-            utrainer.model,
-            vae_data,
-            indices=np.arange(len(vae_data)))
-        latent, _, _ = full_posterior.sequential(batch_size).get_latent()
-        np.save(os.path.join(args.out_dir, 'latent.npy'),
-                latent.astype('float32'))
-
     else:
         stopping_params['early_stopping_metric'] = 'reconstruction_error'
         stopping_params['save_best_state_metric'] = 'reconstruction_error'
 
         # initialize unsupervised trainer
+        # the trainer only calls the model's forward, so it can run compiled
+        # while vae keeps the uncompiled state_dict keys for saving
+        trainer_class = \
+            AutocastUnsupervisedTrainer if args.bf16 else UnsupervisedTrainer
         utrainer = \
-            UnsupervisedTrainer(vae, vae_data,
-                                train_size=(1. - valid_pct),
-                                frequency=2,
-                                metrics_to_monitor=['reconstruction_error'],
-                                use_cuda=args.gpu,
-                                early_stopping_kwargs=stopping_params,
-                                batch_size=batch_size)
+            trainer_class(compile_model(vae, args.gpu) if args.compile else vae,
+                          vae_data,
+                          train_size=(1. - valid_pct),
+                          frequency=2,
+                          metrics_to_monitor=['reconstruction_error'],
+                          use_cuda=args.gpu,
+                          early_stopping_kwargs=stopping_params,
+                          data_loader_kwargs=data_loader_kwargs,
+                          batch_size=batch_size)
         utrainer.history['reconstruction_error_test_set'].append(0)
         # initial epoch
         utrainer.train(n_epochs=2000, lr=learning_rate)
@@ -335,17 +391,37 @@ def main():
         # save VAE
         torch.save(vae.state_dict(), os.path.join(args.out_dir, 'vae.pt'))
 
-        # save latent representation
+    ##################################################
+    # classifier
+
+    # the VAE is frozen from here on, so encode every cell once and train the
+    # classifier on the cached latents instead of re-encoding each minibatch
+    vae.eval()
+    classifier_posterior = utrainer.create_posterior(
+        vae,
+        classifier_data,
+        indices=np.arange(len(classifier_data)))
+    latent_zl = compute_latent_zl(vae,
+                                  classifier_posterior.sequential(batch_size))
+    latent_data = LatentDataset()
+    latent_data.populate_from_data(
+        X=latent_zl,
+        labels=classifier_data.labels,
+        remap_attributes=False)
+
+    # save latent representation, the posterior means of z as get_latent
+    # returns them
+    if args.vae_both:
+        latent = latent_zl[:, :vae.n_latent]
+    else:
         full_posterior = utrainer.create_posterior(
-            utrainer.model,
+            vae,
             vae_data,
             indices=np.arange(len(vae_data)))
-        latent, _, _ = full_posterior.sequential(batch_size).get_latent()
-        np.save(os.path.join(args.out_dir, 'latent.npy'),
-                latent.astype('float32'))
-
-    ##################################################
-    # classifier
+        latent = compute_latent_zl(
+            vae, full_posterior.sequential(batch_size))[:, :vae.n_latent]
+    np.save(os.path.join(args.out_dir, 'latent.npy'),
+            latent.astype('float32'))
 
     # model
     classifier = Classifier(n_input=(vae.n_latent + 1),
@@ -356,12 +432,14 @@ def main():
     # trainer
     stopping_params['early_stopping_metric'] = 'accuracy'
     stopping_params['save_best_state_metric'] = 'accuracy'
-    strainer = ClassifierTrainer(classifier, classifier_data,
+    strainer = ClassifierTrainer(compile_model(classifier, args.gpu)
+                                 if args.compile else classifier,
+                                 latent_data,
                                  train_size=(1. - valid_pct),
                                  frequency=2, metrics_to_monitor=['accuracy'],
                                  use_cuda=args.gpu,
-                                 sampling_model=vae, sampling_zl=True,
                                  early_stopping_kwargs=stopping_params,
+                                 data_loader_kwargs=data_loader_kwargs,
                                  batch_size=batch_size)
 
     # initial
@@ -384,13 +462,13 @@ def main():
     logits_classifier.load_state_dict(classifier.state_dict())
 
     # using logits leads to better performance in for ranking
-    logits_strainer = ClassifierTrainer(logits_classifier, classifier_data,
+    logits_strainer = ClassifierTrainer(logits_classifier, latent_data,
                                         train_size=(1. - valid_pct),
                                         frequency=2,
                                         metrics_to_monitor=['accuracy'],
                                         use_cuda=args.gpu,
-                                        sampling_model=vae, sampling_zl=True,
                                         early_stopping_kwargs=stopping_params,
+                                        data_loader_kwargs=data_loader_kwargs,
                                         batch_size=batch_size)
 
     # models evaluation mode
@@ -398,51 +476,48 @@ def main():
     classifier.eval()
     logits_classifier.eval()
 
-    print('Train accuracy: %.4f' % strainer.train_set.accuracy())
-    print('Test accuracy:  %.4f' % strainer.test_set.accuracy())
-
     # compute predictions manually
-    # output logits
-    train_y, train_score = strainer.train_set.compute_predictions(soft=True)
-    test_y, test_score = strainer.test_set.compute_predictions(soft=True)
+    # one soft pass per posterior, hard predictions are its argmax
+    # inference_mode needs torch >= 1.9
+    with getattr(torch, 'inference_mode', torch.no_grad)():
+        train_y, train_score = strainer.train_set.compute_predictions(soft=True)
+        test_y, test_score = strainer.test_set.compute_predictions(soft=True)
+        order_y, order_score = strainer.compute_predictions(soft=True)
+        # output logits
+        logit_y, logit_score = logits_strainer.compute_predictions(soft=True)
+
+    print('Train accuracy: %.4f' % np.mean(train_y == train_score.argmax(axis=1)))
+    print('Test accuracy:  %.4f' % np.mean(test_y == test_score.argmax(axis=1)))
+
     # train_y == true label
     # train_score[:, 0] == singlet score; train_score[:, 1] == doublet score
-    train_score = train_score[:, 1]
-    train_y = train_y.astype('bool')
-    test_score = test_score[:, 1]
-    test_y = test_y.astype('bool')
-
-    train_auroc = roc_auc_score(train_y, train_score)
-    test_auroc = roc_auc_score(test_y, test_score)
-
-    print('Train AUROC: %.4f' % train_auroc)
-    print('Test AUROC:  %.4f' % test_auroc)
-
-    train_fpr, train_tpr, train_t = roc_curve(train_y, train_score)
-    test_fpr, test_tpr, test_t = roc_curve(test_y, test_score)
+    # scores come back from scvi as float32 numpy, keep them that way
+    train_score = train_score[:, 1].astype(np.float32, copy=False)
+    train_y = train_y.astype(bool, copy=False)
+    test_score = test_score[:, 1].astype(np.float32, copy=False)
+    test_y = test_y.astype(bool, copy=False)
+
+    train_fpr, train_tpr, train_t, train_auroc, train_acc = \
+        roc_summary(train_y, train_score)
+    test_fpr, test_tpr, test_t, test_auroc, test_acc = \
+        roc_summary(test_y, test_score)
     train_t = np.minimum(train_t, 1 + 1e-9)
     test_t = np.minimum(test_t, 1 + 1e-9)
 
-    train_acc = np.zeros(len(train_t))
-    for i in range(len(train_t)):
-        train_acc[i] = np.mean(train_y == (train_score > train_t[i]))
-    test_acc = np.zeros(len(test_t))
-    for i in range(len(test_t)):
-        test_acc[i] = np.mean(test_y == (test_score > test_t[i]))
+    print('Train AUROC: %.4f' % train_auroc)
+    print('Test AUROC:  %.4f' % test_auroc)
 
     # write predictions
     # softmax predictions
-    order_y, order_score = strainer.compute_predictions(soft=True)
-    _, order_pred = strainer.compute_predictions()
-    doublet_score = order_score[:, 1]
+    order_pred = order_score.argmax(axis=1)
+    doublet_score = order_score[:, 1].astype(np.float32, copy=False)
     np.save(os.path.join(args.out_dir, 'no_updates_softmax_scores.npy'), doublet_score[:num_cells])
     np.savetxt(os.path.join(args.out_dir, 'no_updates_softmax_scores.csv'), doublet_score[:num_cells], delimiter=",")
 
     np.save(os.path.join(args.out_dir, 'no_updates_softmax_scores_sim.npy'), doublet_score[num_cells:])
 
     # logit predictions
-    logit_y, logit_score = logits_strainer.compute_predictions(soft=True)
-    logit_doublet_score = logit_score[:, 1]
+    logit_doublet_score = logit_score[:, 1].astype(np.float32, copy=False)
     np.save(os.path.join(args.out_dir, 'logit_scores.npy'), logit_doublet_score[:num_cells])
     np.savetxt(os.path.join(args.out_dir, 'logit_scores.csv'), logit_doublet_score[:num_cells], delimiter=",")
 
@@ -484,8 +559,8 @@ def main():
                    to be doublets. If not change your
                    -e parameter value''')
         assert k > 0
-        idx = np.argpartition(solo_scores, k)
-        threshold = np.max(solo_scores[idx[:k]])
+        # the k-th smallest score, i.e. the max of the k lowest scores
+        threshold = np.partition(solo_scores, k - 1)[k - 1]
         is_solo_doublet = solo_scores > threshold
     else:
         is_solo_doublet = solo_scores > .5
@@ -514,10 +589,12 @@ def main():
         adata.write(os.path.join(args.out_dir, "soloed.h5ad"))
 
     if args.plot:
+        # plotting libraries are slow to import, only load them when asked
         import matplotlib
-        #matplotlib.use('Agg')
+        matplotlib.use('Agg')
         import matplotlib.pyplot as plt
         import seaborn as sns
+        import umap
         # plot ROC
         plt.figure()
         plt.plot(train_fpr, train_tpr, label='Train')
@@ -563,6 +640,7 @@ def main():
         ax.set_xticks([], [])
         ax.set_yticks([], [])
         fig.savefig(os.path.join(args.out_dir, 'umap_solo_scores.pdf'))
+        plt.close(fig)
 
 ###############################################################################
 # __main__
@@ -1,10 +1,37 @@
+import logging
+import os
+import warnings
+
+import anndata
 import numpy as np
+import torch
 
 from scvi.dataset import GeneExpressionDataset
+from scvi.inference import UnsupervisedTrainer
 from scipy.sparse import csr_matrix, issparse
-from scipy.stats import multinomial
 from sklearn.neighbors import NearestNeighbors
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+# compute_library_size logs its empty cell warning here
+scvi_logger = logging.getLogger('scvi.dataset.dataset')
+
+# numba threading layer that survives DataLoader workers forking after the
+# multinomial kernel has started its thread pool (TBB hangs at exit)
+NUMBA_THREADING_LAYER = 'workqueue'
+
+# memory budget for simulating one chunk of dense doublets
+DOUBLET_CHUNK_BYTES = 2 ** 30
+
 
 def knn_smooth_pred_class(X: np.ndarray,
                           pred_class: np.ndarray,
@@ -72,104 +99,341 @@ def knn_smooth_pred_class(X: np.ndarray,
     return smooth_pred_class
 
 
-def create_average_doublet(X: np.ndarray,
-                           i: int,
-                           j: int, **kwargs):
-    '''make an average combination of 2 cells
+def roc_summary(y: np.ndarray, score: np.ndarray):
+    '''ROC curve, AUROC and accuracy per threshold from a single sort
+
+    Parameters
+    ----------
+    y : np.ndarray
+        [N,] boolean true labels.
+    score : np.ndarray
+        [N,] scores, higher means more likely positive.
+    Returns
+    -------
+    fpr : np.ndarray
+        [T,] false positive rate calling `score >= threshold` positive.
+    tpr : np.ndarray
+        [T,] true positive rate calling `score >= threshold` positive.
+    thresholds : np.ndarray
+        [T,] decreasing thresholds, the first one is `np.inf`.
+    auroc : float
+        area under the ROC curve.
+    accuracy : np.ndarray
+        [T,] fraction of samples where `score > threshold` equals `y`.
+    Notes
+    -----
+    Matches `sklearn.metrics.roc_curve` and `roc_auc_score`, but sorts the
+    scores once and derives all outputs from the same cumulative true and
+    false positive counts.
+    '''
+    y = np.asarray(y, dtype=bool)
+    order = np.argsort(-score, kind='mergesort')
+    score_sorted = score[order]
+
+    # cumulative counts at the last position of each distinct score
+    threshold_idx = np.concatenate([np.flatnonzero(np.diff(score_sorted)),
+                                    [len(y) - 1]])
+    tps = np.cumsum(y[order])[threshold_idx]
+    fps = 1 + threshold_idx - tps
+    thresholds = score_sorted[threshold_idx]
+
+    # drop points collinear with their neighbors, like roc_curve does
+    if len(fps) > 2:
+        keep = np.flatnonzero(np.r_[True,
+                                    np.logical_or(np.diff(fps, 2),
+                                                  np.diff(tps, 2)),
+                                    True])
+    else:
+        keep = np.arange(len(fps))
+
+    # prepend the (0, 0) point for an infinite threshold
+    tps = np.concatenate([[0], tps])
+    fps = np.concatenate([[0], fps])
+    thresholds = np.concatenate([[np.inf], thresholds])
+    n_pos, n_neg = tps[-1], fps[-1]
+
+    # score > threshold calls the samples above the next higher threshold
+    # positive, i.e. the counts of the previous point
+    accuracy = (np.concatenate([[0], tps[:-1]]) + n_neg
+                - np.concatenate([[0], fps[:-1]])) / len(y)
+
+    keep = np.concatenate([[0], keep + 1])
+    fpr = fps[keep] / n_neg
+    tpr = tps[keep] / n_pos
+    auroc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+    return fpr, tpr, thresholds[keep], auroc, accuracy[keep]
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _multinomial_csr(depths, probs, indptr, seeds):
+        '''sample multinomial counts for every row of a CSR matrix
+
+        Each row is drawn as a chain of conditional binomials over its
+        nonzero genes, from a generator seeded per row so the result does
+        not depend on how rows are spread over threads.
+        '''
+        counts = np.zeros_like(probs)
+        for k in numba.prange(len(depths)):
+            np.random.seed(seeds[k])
+            remaining_n = depths[k]
+            remaining_p = 1.
+            last = indptr[k + 1] - 1
+            for g in range(indptr[k], indptr[k + 1]):
+                if remaining_n <= 0:
+                    break
+                if g == last or probs[g] >= remaining_p:
+                    counts[g] = remaining_n
+                    break
+                count = np.random.binomial(remaining_n, probs[g] / remaining_p)
+                counts[g] = count
+                remaining_n -= count
+                remaining_p -= probs[g]
+        return counts
+
+
+def create_average_doublets(X: np.ndarray,
+                            I: np.ndarray,
+                            J: np.ndarray, **kwargs):
+    '''make average combinations of pairs of cells
 
     Parameters
     ----------
     X : np.array
       cell by genes matrix
-    i : int,
-      randomly chosen ith cell
-    j : int,
-      randomly chosen jth cell
+    I : np.array,
+      randomly chosen first cell of each doublet
+    J : np.array,
+      randomly chosen second cell of each doublet
     Returns
     -------
-    float
-        average expression vector of two cells
+    np.array
+        doublets by genes matrix of averaged expression
     '''
-    return X[i] + X[j] / 2
+    # scipy promotes a float32 sparse matrix divided by 2 to float64
+    return ((X[I] + X[J]) / 2).astype(X.dtype, copy=False)
 
 
-def create_summed_doublet(X: np.ndarray,
-                          i: int,
-                          j: int, **kwargs):
-    '''make a sum combination of 2 cells
+def create_summed_doublets(X: np.ndarray,
+                           I: np.ndarray,
+                           J: np.ndarray, **kwargs):
+    '''make sum combinations of pairs of cells
 
     Parameters
     ----------
     X : np.array
       cell by genes matrix
-    i : int,
-      randomly chosen ith cell
-    j : int,
-      randomly chosen jth cell
+    I : np.array,
+      randomly chosen first cell of each doublet
+    J : np.array,
+      randomly chosen second cell of each doublet
     Returns
     -------
-    float
-        summed expression vector of two cells
+    np.array
+        doublets by genes matrix of summed expression
     '''
-    return X[i] + X[j]
+    return X[I] + X[J]
 
 
-def create_multinomial_doublet(X: np.ndarray,
-                               i: int,
-                               j: int, **kwargs):
-    '''make a multinomial combination of 2 cells
+def create_multinomial_doublets(X: np.ndarray,
+                                I: np.ndarray,
+                                J: np.ndarray, **kwargs):
+    '''make multinomial combinations of pairs of cells
 
     Parameters
     ----------
     X : np.array
         cell by genes matrix
-    i : int,
-        randomly chosen ith cell
-    j : int,
-        randomly chosen jth cell
+    I : np.array,
+        randomly chosen first cell of each doublet
+    J : np.array,
+        randomly chosen second cell of each doublet
     kwargs : dict,
-        dict with doublet_depth, cell_depths and cells_ids as keys
+        dict with doublet_depth, cell_depths, randomize_doublet_size and rng
+        as keys
         doublet_depth is an int
-        cell_depths is an list of all cells total UMI counts as ints
-        cell_ids list of lists with genes with counts for each cell
+        cell_depths is an np.array of all cells total UMI counts
+        randomize_doublet_size is a bool
+        rng is a np.random.Generator used to sample depths and counts
     Returns
     -------
-    float
-        multinomial expression vector of two cells
+    np.array
+        doublets by genes matrix of multinomial expression
     '''
     doublet_depth = kwargs["doublet_depth"]
     cell_depths = kwargs["cell_depths"]
-    cells_ids = kwargs["cells_ids"]
     randomize_doublet_size = kwargs["randomize_doublet_size"]
+    rng = kwargs["rng"]
 
-    # add their counts
-    dp = X[i] + X[j]
-    non_zero_indexes = np.unique(cells_ids[i] + cells_ids[j])
-    if issparse(X):
-        dp = dp.data
-    else:
-        dp = np.ravel(dp)
-        dp = dp[non_zero_indexes]
-
-    # a huge hack caused by
+    # add their counts, in float64 since float32 probabilities can sum past 1
     # https://github.com/numpy/numpy/issues/8317
-    # fun fun fun https://stackoverflow.com/questions/23257587/how-can-i-avoid-value-errors-when-using-numpy-random-multinomial
-    # okay with this hack because affects pro
+    dp = (X[I] + X[J]).astype(np.float64)
 
-    # normalize
-    dp /= dp.sum()
     if randomize_doublet_size:
-        scale_factor = np.random.uniform(1., doublet_depth)
+        scale_factors = rng.uniform(1., doublet_depth, size=len(I))
     else:
-        scale_factor = doublet_depth
-    # choose depth
-    dd = int(scale_factor * (cell_depths[i] + cell_depths[j]) / 2)
+        scale_factors = np.full(len(I), doublet_depth)
+
+    # choose depths
+    dd = (scale_factors * (cell_depths[I] + cell_depths[J]) / 2).astype(np.int64)
+
+    # sample counts from multinomial, numpy draws these as a chain of
+    # conditional binomials so the cost scales with genes, not depth
+    if issparse(dp):
+        # only genes expressed in either cell can get counts, so sample over
+        # each row's nonzeros in place and keep the doublets sparse
+        doublets = dp.tocsr()
+        row_sums = np.asarray(doublets.sum(axis=1)).ravel()
+        doublets.data /= np.repeat(row_sums, np.diff(doublets.indptr))
+        if numba is not None:
+            seeds = rng.integers(2 ** 31 - 1, size=len(I))
+            doublets.data = _multinomial_csr(dd, doublets.data,
+                                             doublets.indptr, seeds)
+        else:
+            for k in range(len(I)):
+                row = slice(doublets.indptr[k], doublets.indptr[k + 1])
+                doublets.data[row] = rng.multinomial(dd[k], doublets.data[row])
+        doublets.eliminate_zeros()
+    else:
+        # n broadcasts against the rows of pvals, one call for the chunk
+        doublets = rng.multinomial(dd, dp / dp.sum(axis=1, keepdims=True))
+    return doublets.astype(X.dtype)
+
+
+def set_num_threads(num_threads: int):
+    '''limit the threads used by BLAS/OpenMP, torch and numba
+
+    Parameters
+    ----------
+    num_threads : int
+        maximum number of threads for each thread pool
+    '''
+    # numpy and scipy are already imported, so the environment only reaches
+    # child processes; threadpoolctl resizes the loaded BLAS/OpenMP pools
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(num_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(num_threads)
+    torch.set_num_threads(num_threads)
+    if numba is not None:
+        numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def compile_model(model: torch.nn.Module, use_cuda: bool):
+    '''compile a model's forward pass with torch.compile when available
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        scVI model to compile, e.g. a VAE or Classifier
+    use_cuda : bool,
+        whether the model will run on GPU
+    Returns
+    -------
+    torch.nn.Module
+        compiled model sharing parameters with `model`, or `model` itself if
+        this version of torch has no torch.compile
+    '''
+    if not hasattr(torch, 'compile'):
+        print('torch.compile requires torch >= 2.0, running uncompiled!')
+        return model
+    # cuda graphs only pay off on GPU, on CPU use the default inductor mode
+    mode = 'reduce-overhead' if use_cuda else 'default'
+    return torch.compile(model, mode=mode)
+
+
+class AutocastUnsupervisedTrainer(UnsupervisedTrainer):
+    '''UnsupervisedTrainer computing the VAE loss under bfloat16 autocast
+
+    The encoder and decoder matmuls run in bfloat16 on GPU while the
+    parameters, gradients and optimizer stay in float32. Softmax, exp and
+    log are autocast to float32, so the NB likelihood keeps full precision.
+    '''
+
+    def loss(self, tensors, feed_labels=True):
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            return super().loss(tensors, feed_labels=feed_labels)
+
+
+class CountsDataset(GeneExpressionDataset):
+    '''GeneExpressionDataset computing its library size priors from one row sum
+
+    scvi gathers each batch's rows with a boolean mask before summing them,
+    which for the usual single batch dataset is a full copy of X. The row
+    sums give the same log statistics without touching X twice.
+    '''
 
-    # sample counts from multinomial
-    non_zero_probs = multinomial.rvs(n=dd, p=dp)
-    probs = np.zeros(X.shape[1])
-    probs[non_zero_indexes] = non_zero_probs
-    return csr_matrix(probs) if issparse(X) else probs
+    def compute_library_size_batch(self):
+        log_counts = np.ma.log(np.asarray(self.X.sum(axis=1)).ravel())
+        if np.ma.is_masked(log_counts):
+            scvi_logger.warning(
+                "This dataset has some empty cells, this might fail scVI "
+                "inference. Data should be filtered with "
+                "`my_dataset.filter_cells_by_count()")
+        log_counts = log_counts.filled(0)
+        batch_indices = np.ravel(self.batch_indices)
+        self.local_means = np.zeros((self.nb_cells, 1))
+        self.local_vars = np.zeros((self.nb_cells, 1))
+        for i_batch in range(self.n_batches):
+            idx_batch = batch_indices == i_batch
+            self.local_means[idx_batch] = \
+                np.mean(log_counts[idx_batch]).astype(np.float32)
+            self.local_vars[idx_batch] = \
+                np.var(log_counts[idx_batch]).astype(np.float32)
+        self.cell_attribute_names.update(['local_means', 'local_vars'])
+
+
+class LatentDataset(GeneExpressionDataset):
+    '''GeneExpressionDataset holding latent embeddings rather than counts
+
+    Library sizes mean nothing for embeddings, so they are left at zero
+    rather than computed from the log of each row's sum.
+    '''
+
+    def compute_library_size_batch(self):
+        self.local_means = np.zeros((self.nb_cells, 1))
+        self.local_vars = np.zeros((self.nb_cells, 1))
+        self.cell_attribute_names.update(["local_means", "local_vars"])
+
+
+@torch.no_grad()
+def compute_latent_zl(vae: torch.nn.Module, posterior) -> np.ndarray:
+    '''encode cells the way ClassifierTrainer does with sampling_zl=True
+
+    Parameters
+    ----------
+    vae : scvi.models.VAE
+        trained VAE, in eval mode
+    posterior : scvi.inference.Posterior
+        sequential posterior over the cells to encode
+    Returns
+    -------
+    latent_zl : np.ndarray
+        [N, n_latent + 1] posterior means of z concatenated with the
+        posterior mean of the log library size
+    '''
+    latent_zl = []
+    z_encoder = l_encoder = None
+    for tensors in posterior:
+        x = tensors[0]
+        if vae.log_variational:
+            x = torch.log(1 + x)
+        if z_encoder is None:
+            # trace the eval-mode encoders once on the first batch so the
+            # rest of the pass skips the python-level layer dispatch; the
+            # sampled outputs differ between runs, hence check_trace=False.
+            # newer torch deprecates jit.trace with a FutureWarning, which
+            # says nothing actionable to solo users
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', torch.jit.TracerWarning)
+                warnings.simplefilter('ignore', FutureWarning)
+                z_encoder = torch.jit.trace(vae.z_encoder, x,
+                                            check_trace=False)
+                l_encoder = torch.jit.trace(vae.l_encoder, x,
+                                            check_trace=False)
+        latent_zl.append(torch.cat((z_encoder(x)[0],
+                                    l_encoder(x)[0]), dim=-1).cpu())
+    return torch.cat(latent_zl).numpy()
 
 
 def make_gene_expression_dataset(data: np.ndarray, gene_names: np.ndarray):
@@ -186,6 +450,59 @@ def make_gene_expression_dataset(data: np.ndarray, gene_names: np.ndarray):
     ge_data : GeneExpressionDataset
         scVI GeneExpressionDataset for scVI processing
     '''
-    ge_data = GeneExpressionDataset()
+    ge_data = CountsDataset()
     ge_data.populate_from_data(X=data, gene_names=gene_names)
     return ge_data
+
+
+SCDL_ARRAYS = ('data', 'indices', 'indptr')
+
+
+def convert_to_scdl(h5ad_path: str, scdl_path: str = None) -> str:
+    '''write the counts of an h5ad file as memory-mappable CSR arrays
+
+    Parameters
+    ----------
+    h5ad_path : str
+        path to h5ad file containing cell by genes counts
+    scdl_path : str,
+        output directory, defaults to `h5ad_path` with a .scdl extension
+    Returns
+    -------
+    scdl_path : str
+        directory holding data.npy, indices.npy, indptr.npy, shape.npy and
+        gene_names.npy, which solo reads with `load_scdl`
+    '''
+    if scdl_path is None:
+        scdl_path = os.path.splitext(h5ad_path)[0] + '.scdl'
+    os.makedirs(scdl_path, exist_ok=True)
+
+    adata = anndata.read_h5ad(h5ad_path)
+    X = csr_matrix(adata.X)
+    for name in SCDL_ARRAYS:
+        np.save(os.path.join(scdl_path, f'{name}.npy'), getattr(X, name))
+    np.save(os.path.join(scdl_path, 'shape.npy'), np.asarray(X.shape))
+    np.save(os.path.join(scdl_path, 'gene_names.npy'),
+            np.asarray(adata.var_names, dtype=str))
+    return scdl_path
+
+
+def load_scdl(scdl_path: str):
+    '''make an scVI GeneExpressionDataset backed by memory-mapped CSR arrays
+
+    Parameters
+    ----------
+    scdl_path : str
+        directory written by `convert_to_scdl`
+    Returns
+    -------
+    ge_data : GeneExpressionDataset
+        scVI GeneExpressionDataset whose X is a csr_matrix over np.memmap
+        arrays, so rows are paged in from disk as they are sliced
+    '''
+    arrays = [np.load(os.path.join(scdl_path, f'{name}.npy'), mmap_mode='r')
+              for name in SCDL_ARRAYS]
+    shape = tuple(np.load(os.path.join(scdl_path, 'shape.npy')))
+    gene_names = np.load(os.path.join(scdl_path, 'gene_names.npy'))
+    X = csr_matrix(tuple(arrays), shape=shape, copy=False)
+    return make_gene_expression_dataset(X, gene_names)
@@ -0,0 +1,198 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from solo import utils
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+def _counts():
+    np.random.seed(52)
+    return np.random.poisson(1, size=(50, 20)).astype(np.float32)
+
+
+def test_average_and_summed_doublets():
+    x = _counts()
+    I = np.arange(10)
+    J = np.arange(10, 20)
+
+    summed = utils.create_summed_doublets(x, I, J)
+    assert summed.dtype == x.dtype
+    assert np.allclose(summed, x[I] + x[J])
+    averaged = utils.create_average_doublets(x, I, J)
+    assert averaged.dtype == x.dtype
+    assert np.allclose(averaged, (x[I] + x[J]) / 2)
+
+    sparse_summed = utils.create_summed_doublets(csr_matrix(x), I, J)
+    assert issparse(sparse_summed)
+    assert sparse_summed.dtype == x.dtype
+    assert np.allclose(sparse_summed.toarray(), summed)
+    sparse_averaged = utils.create_average_doublets(csr_matrix(x), I, J)
+    assert issparse(sparse_averaged)
+    assert sparse_averaged.dtype == x.dtype
+    assert np.allclose(sparse_averaged.toarray(), averaged)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_multinomial_doublets(sparse):
+    x = _counts()
+    cell_depths = x.sum(axis=1)
+    I = np.arange(10)
+    J = np.arange(10, 20)
+
+    doublets = utils.create_multinomial_doublets(
+        csr_matrix(x) if sparse else x, I, J,
+        doublet_depth=2., cell_depths=cell_depths,
+        randomize_doublet_size=False, rng=np.random.default_rng(52))
+    assert doublets.dtype == x.dtype
+    if sparse:
+        assert issparse(doublets)
+        doublets = doublets.toarray()
+
+    assert doublets.shape == (10, 20)
+    # every doublet gets the summed depth of its two cells
+    assert np.allclose(doublets.sum(axis=1), cell_depths[I] + cell_depths[J])
+    # counts only land on genes expressed by one of the two cells
+    assert not np.any(doublets[(x[I] + x[J]) == 0])
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_compute_library_size_batch(sparse):
+    x = _counts()
+    batch_indices = (np.arange(50) % 2).reshape(-1, 1)
+    dataset = SimpleNamespace(X=csr_matrix(x) if sparse else x,
+                              batch_indices=batch_indices,
+                              nb_cells=50, n_batches=2,
+                              cell_attribute_names=set())
+    utils.CountsDataset.compute_library_size_batch(dataset)
+
+    log_counts = np.log(x.sum(axis=1))
+    for i_batch in range(2):
+        idx_batch = np.ravel(batch_indices) == i_batch
+        assert np.allclose(dataset.local_means[idx_batch],
+                           np.mean(log_counts[idx_batch]))
+        assert np.allclose(dataset.local_vars[idx_batch],
+                           np.var(log_counts[idx_batch]))
+    assert dataset.cell_attribute_names == {'local_means', 'local_vars'}
+
+
+def test_multinomial_doublets_without_numba(monkeypatch):
+    monkeypatch.setattr(utils, 'numba', None)
+    x = _counts()
+    cell_depths = x.sum(axis=1)
+    I = np.arange(10)
+    J = np.arange(10, 20)
+
+    doublets = utils.create_multinomial_doublets(
+        csr_matrix(x), I, J,
+        doublet_depth=2., cell_depths=cell_depths,
+        randomize_doublet_size=False, rng=np.random.default_rng(52))
+    assert issparse(doublets)
+    doublets = doublets.toarray()
+    assert np.allclose(doublets.sum(axis=1), cell_depths[I] + cell_depths[J])
+    assert not np.any(doublets[(x[I] + x[J]) == 0])
+
+
+FORKED_WORKERS_SCRIPT = '''
+import numba
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+from solo import utils
+
+# importing solo leaves numba alone, main() picks the layer
+assert numba.config.THREADING_LAYER == 'default'
+numba.config.THREADING_LAYER = utils.NUMBA_THREADING_LAYER
+
+x = csr_matrix(np.random.default_rng(52).poisson(1, size=(50, 20)))
+utils.create_multinomial_doublets(
+    x, np.arange(10), np.arange(10, 20),
+    doublet_depth=2., cell_depths=np.asarray(x.sum(axis=1)).ravel(),
+    randomize_doublet_size=False, rng=np.random.default_rng(52))
+loader = torch.utils.data.DataLoader(
+    torch.utils.data.TensorDataset(torch.arange(20)), num_workers=2)
+for batch in loader:
+    pass
+'''
+
+
+def test_multinomial_doublets_then_forked_workers_exit():
+    # forking DataLoader workers after the numba kernel used to hang the
+    # interpreter at exit
+    pytest.importorskip('numba')
+    env = dict(os.environ)
+    env.pop('NUMBA_THREADING_LAYER', None)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [repo_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    subprocess.run([sys.executable, '-c', FORKED_WORKERS_SCRIPT],
+                   env=env, check=True, timeout=120)
+
+
+@pytest.mark.parametrize('constant', [False, True])
+def test_roc_summary(constant):
+    from sklearn.metrics import roc_auc_score, roc_curve
+    np.random.seed(52)
+    y = np.random.rand(200) > .5
+    if constant:
+        # a saturated classifier gives a single threshold
+        score = np.ones(200, dtype=np.float32)
+    else:
+        score = np.round(np.random.rand(200) * .5 + y * .3, 2)
+
+    fpr, tpr, thresholds, auroc, accuracy = utils.roc_summary(y, score)
+    sk_fpr, sk_tpr, sk_thresholds = roc_curve(y, score)
+    assert np.allclose(fpr, sk_fpr)
+    assert np.allclose(tpr, sk_tpr)
+    assert np.allclose(thresholds[1:], sk_thresholds[1:])
+    assert np.isclose(auroc, roc_auc_score(y, score))
+
+    expected = [np.mean(y == (score > t)) for t in thresholds]
+    assert np.allclose(accuracy, expected)
+
+
+def test_scdl_roundtrip(tmp_path):
+    from anndata import AnnData
+    x = _counts()
+    h5ad_path = str(tmp_path / 'counts.h5ad')
+    AnnData(csr_matrix(x)).write(h5ad_path)
+
+    scdl_path = utils.convert_to_scdl(h5ad_path)
+    assert scdl_path == str(tmp_path / 'counts.scdl')
+    scdl_data = utils.load_scdl(scdl_path)
+    assert issparse(scdl_data.X)
+    assert np.allclose(scdl_data.X.toarray(), x)
+    assert len(scdl_data.gene_names) == x.shape[1]
+
+
+def test_compute_latent_zl():
+    import torch
+
+    class Encoder(torch.nn.Module):
+        def __init__(self, n_output):
+            super().__init__()
+            self.linear = torch.nn.Linear(20, n_output)
+
+        def forward(self, x):
+            q_m = self.linear(x)
+            return q_m, torch.exp(q_m), q_m
+
+    vae = torch.nn.Module()
+    vae.log_variational = True
+    vae.z_encoder = Encoder(4)
+    vae.l_encoder = Encoder(1)
+
+    x = torch.from_numpy(_counts())
+    posterior = [(x[:25],), (x[25:],)]
+    latent_zl = utils.compute_latent_zl(vae, posterior)
+
+    log_x = torch.log(1 + x)
+    expected = torch.cat((vae.z_encoder(log_x)[0],
+                          vae.l_encoder(log_x)[0]), dim=-1)
+    assert latent_zl.shape == (50, 5)
+    assert np.allclose(latent_zl, expected.detach().numpy(), atol=1e-6)